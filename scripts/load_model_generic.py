@@ -8,44 +8,363 @@ Supports:
 Handles 4-bit/8-bit/none quantization for Transformers models with PEFT.
 """
 
-from typing import Tuple, Optional
+from typing import Any, Dict, List, Literal, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import importlib.util
 import os
 
 try:
-    from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+    from transformers import (
+        AutoConfig,
+        AutoTokenizer,
+        AutoModelForCausalLM,
+        BitsAndBytesConfig,
+    )
 except Exception:
     # VS Code local environment may not have transformers installed.
     # Colab installs this in the first cell; locally, this is editor-only.
-    AutoTokenizer = AutoModelForCausalLM = BitsAndBytesConfig = object  # type: ignore[misc]
+    AutoConfig = AutoTokenizer = object  # type: ignore[misc]
+    AutoModelForCausalLM = BitsAndBytesConfig = object  # type: ignore[misc]
+
+try:
+    import torch  # installed in Colab
+except Exception:
+    torch = None  # type: ignore[assignment]
+
+
+TorchDtype = Literal["bf16", "fp16", "fp32", "bfloat16", "float16", "float32"]
+
+_DTYPE_NAMES = {
+    "bf16": "bfloat16",
+    "bfloat16": "bfloat16",
+    "fp16": "float16",
+    "float16": "float16",
+    "fp32": "float32",
+    "float32": "float32",
+}
+
+
+def _bf16_native() -> bool:
+    # BF16 tensor cores need Ampere (sm_80) or newer; older GPUs only emulate it.
+    if torch is None or not torch.cuda.is_available():
+        return True  # CPU / editor-only: nothing to fall back from
+    return torch.cuda.get_device_capability()[0] >= 8
+
+
+def _resolve_dtype(torch_dtype: TorchDtype) -> Optional["torch.dtype"]:
+    """Maps a dtype name (e.g. "bf16" / "bfloat16") to a real torch.dtype."""
+    if torch_dtype not in _DTYPE_NAMES:
+        raise ValueError(f"Unknown torch_dtype: {torch_dtype}")
+    name = _DTYPE_NAMES[torch_dtype]
+    if torch is None:
+        return None  # fallback: let transformers decide
+    if name == "bfloat16" and not _bf16_native():
+        print("[WARN] bf16 is emulated on this GPU (pre-Ampere); using fp16 instead")
+        name = "float16"
+    return getattr(torch, name)
 
 
-def _maybe_quant_config(quantization: str) -> Optional["BitsAndBytesConfig"]:
+def _compute_dtype() -> Optional["torch.dtype"]:
+    return _resolve_dtype("bfloat16" if _bf16_native() else "float16")
+
+
+def _estimate_params_b(model_path: str) -> Optional[float]:
+    """Rough parameter count (billions) from the model config (local dir or hub id)."""
     try:
-        if quantization == "4bit":
-            return BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_use_double_quant=True,
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_compute_dtype="bfloat16",  # handled by transformers
-            )
-        if quantization == "8bit":
-            return BitsAndBytesConfig(load_in_8bit=True)
+        cfg = AutoConfig.from_pretrained(model_path)
+        cfg = getattr(cfg, "text_config", None) or cfg  # e.g. Gemma 3 nests it
+        hidden, layers = cfg.hidden_size, cfg.num_hidden_layers
     except Exception:
+        return None
+    # ~12*h^2 per decoder layer (attention + MLP) plus the embedding matrix
+    vocab = getattr(cfg, "vocab_size", 0) or 0
+    return (12 * layers * hidden**2 + vocab * hidden) / 1e9
+
+
+def _maybe_quant_config(
+    quantization: str,
+    quant_type: str = "nf4",
+    double_quant: bool = True,
+) -> Optional["BitsAndBytesConfig"]:
+    if quantization == "4bit":
+        # Config values come from YAML; fail loudly rather than load unquantized.
+        if quant_type not in ("nf4", "fp4"):
+            raise ValueError(f"Unknown bnb_4bit_quant_type: {quant_type!r}")
+        if not isinstance(double_quant, bool):
+            raise ValueError(
+                f"bnb_4bit_use_double_quant must be true/false, got {double_quant!r}"
+            )
+    if BitsAndBytesConfig is object:
         # In local/editor-only context without transformers, just skip.
         return None
+    if quantization == "4bit":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=double_quant,
+            bnb_4bit_quant_type=quant_type,
+            bnb_4bit_compute_dtype=_compute_dtype(),
+        )
+    if quantization == "8bit":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    return None
+
+
+def _prefetch_shards(model_path: str) -> None:
+    """Warms the page cache for all *.safetensors shards in parallel (Linux)."""
+    if not os.path.isdir(model_path) or not hasattr(os, "posix_fadvise"):
+        return  # HF repo id (downloaded by transformers) or non-Linux host
+    # Top-level only, matching the files `from_pretrained` actually loads.
+    shards = [str(p) for p in Path(model_path).glob("*.safetensors")]
+    if not shards:
+        return
+
+    def _willneed(path: str) -> None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    with ThreadPoolExecutor(max_workers=min(len(shards), os.cpu_count() or 4)) as ex:
+        list(ex.map(_willneed, shards))
+
+
+def _resolve_attn_impl(attn_impl: str, dtype: Optional["torch.dtype"]) -> str:
+    if attn_impl != "flash_attention_2":
+        return attn_impl
+    # FlashAttention-2 needs the flash_attn package, an Ampere+ GPU and
+    # fp16/bf16 weights.
+    if torch is None or dtype not in (torch.float16, torch.bfloat16):
+        return "sdpa"
+    if importlib.util.find_spec("flash_attn") is None:
+        return "sdpa"
+    if not torch.cuda.is_available():
+        return "sdpa"
+    if torch.cuda.get_device_capability()[0] < 8:
+        return "sdpa"
+    return attn_impl
+
+
+def _use_safetensors(model_path: str) -> Optional[bool]:
+    # Force safetensors (zero-copy mmap) when a local checkpoint ships them;
+    # otherwise let transformers prefer them and fall back to pickled .bin.
+    # Only top-level weight files are loaded; ignore subfolders.
+    if os.path.isdir(model_path) and any(Path(model_path).glob("*.safetensors")):
+        return True
     return None
 
 
+class _PrefetchedWeights:
+    """
+    Wraps an accelerate offload `weights_map`: tensors copied to the GPU ahead
+    of time on a side stream are served from `ready`, the rest fall through.
+    """
+
+    def __init__(self, weights_map: Any):
+        self.weights_map = weights_map
+        self.ready: Dict[str, Any] = {}
+        self.event: Optional[Any] = None
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self.ready:
+            stream = torch.cuda.current_stream()
+            stream.wait_event(self.event)
+            tensor = self.ready.pop(key)
+            tensor.record_stream(stream)
+            return tensor
+        return self.weights_map[key]
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.weights_map, name)  # keys(), items(), ...
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.weights_map
+
+    def __iter__(self):
+        return iter(self.weights_map)
+
+    def __len__(self) -> int:
+        return len(self.weights_map)
+
+
+def _decoder_layers(model: Any) -> List[Any]:
+    # Where common HF architectures keep their decoder block list.
+    for path in (
+        "model.layers",
+        "model.language_model.layers",
+        "transformer.h",
+        "gpt_neox.layers",
+    ):
+        mod = model
+        for attr in path.split("."):
+            mod = getattr(mod, attr, None)
+        if mod is not None:
+            return list(mod)
+    return []
+
+
+def _offload_hooks(layer: Any) -> List[Tuple[Any, Any]]:
+    """(submodule, AlignDevicesHook) pairs whose weights accelerate offloads."""
+    found = []
+    for sub in layer.modules():
+        hook = getattr(sub, "_hf_hook", None)
+        for h in getattr(hook, "hooks", [hook]):  # SequentialHook or single hook
+            if (
+                getattr(h, "offload", False)
+                and getattr(h, "weights_map", None) is not None
+            ):
+                found.append((sub, h))
+    return found
+
+
+def _attach_offload_prefetch(model: Any, prefetch_k: int) -> int:
+    """
+    For layers that accelerate offloads to CPU, copies the weights of
+    layer i+1..i+k to the GPU on a side stream while layer i runs. The CPU
+    copies are pinned so the transfers are truly async; disk-backed weights
+    are left to accelerate's own (synchronous) loading.
+
+    `prefetch_k` is capped so the in-flight layers fit in half of the free
+    GPU memory. Returns the number of offloaded layers hooked (0 = no-op).
+    """
+    placements = set(getattr(model, "hf_device_map", {}).values())
+    if prefetch_k <= 0 or torch is None or not torch.cuda.is_available():
+        return 0
+    if not placements & {"cpu", "disk"}:
+        return 0  # everything already lives on the GPU
+
+    layers = _decoder_layers(model)
+    plans: List[List[Tuple[_PrefetchedWeights, List[Tuple[str, Any]], Any]]] = []
+    layer_bytes: List[int] = []
+    for layer in layers:
+        plan = []
+        for sub, hook in _offload_hooks(layer):
+            # weights_map is a PrefixedDataset over accelerate's
+            # OffloadedWeightsLoader; its `state_dict` holds the CPU-offloaded
+            # tensors, disk-backed ones are only in its index.
+            loader = getattr(hook.weights_map, "dataset", None)
+            cpu_weights = getattr(loader, "state_dict", None)
+            prefix = getattr(hook.weights_map, "prefix", "")
+            if not isinstance(cpu_weights, dict):
+                continue
+            sources = []
+            for n, _ in sub.named_parameters(recurse=False):
+                key = prefix + n
+                if key not in cpu_weights:
+                    continue  # disk-backed
+                if not cpu_weights[key].is_pinned():
+                    cpu_weights[key] = cpu_weights[key].pin_memory()
+                sources.append((n, cpu_weights[key]))
+            if not sources:
+                continue
+            wrapped = _PrefetchedWeights(hook.weights_map)
+            hook.weights_map = wrapped
+            plan.append((wrapped, sources, hook.execution_device))
+        plans.append(plan)
+        layer_bytes.append(
+            sum(t.numel() * t.element_size() for _, s, _ in plan for _, t in s)
+        )
+
+    if not any(layer_bytes):
+        return 0
+    # Leave half of the free memory for activations / KV cache.
+    free, _ = torch.cuda.mem_get_info()
+    prefetch_k = min(prefetch_k, (free // 2) // max(layer_bytes))
+    if prefetch_k <= 0:
+        print("[WARN] Not enough free GPU memory to prefetch offloaded layers")
+        return 0
+
+    stream = torch.cuda.Stream()
+
+    def _prefetch(j: int) -> None:
+        with torch.cuda.stream(stream):
+            for wrapped, sources, device in plans[j]:
+                if wrapped.ready:
+                    continue  # already in flight
+                for n, tensor in sources:
+                    wrapped.ready[n] = tensor.to(device, non_blocking=True)
+                wrapped.event = torch.cuda.Event()
+                wrapped.event.record(stream)
+
+    def _make_pre_hook(i: int):
+        def pre_hook(module, args):
+            for j in range(i + 1, min(i + 1 + prefetch_k, len(plans))):
+                _prefetch(j)
+
+        return pre_hook
+
+    def _make_post_hook(i: int):
+        def post_hook(module, args, output):
+            # Drop copies accelerate did not consume so the next forward re-fetches.
+            for wrapped, _, _ in plans[i]:
+                wrapped.ready.clear()
+
+        return post_hook
+
+    hooked = 0
+    for i, layer in enumerate(layers):
+        layer.register_forward_pre_hook(_make_pre_hook(i))
+        if plans[i]:
+            layer.register_forward_hook(_make_post_hook(i))
+            hooked += 1
+    print(f"[i] Prefetching {hooked} offloaded layers ({prefetch_k} ahead)")
+    return hooked
+
+
+def _load_tokenizer(model_path: str) -> "AutoTokenizer":
+    try:
+        return AutoTokenizer.from_pretrained(model_path, use_fast=True)
+    except (ValueError, ImportError) as fast_err:
+        # Some older checkpoints (e.g. early Llama) ship no fast variant and
+        # cannot be converted; network/auth/missing-file errors propagate as is.
+        try:
+            return AutoTokenizer.from_pretrained(model_path, use_fast=False)
+        except Exception:
+            raise fast_err
+
+
 def load_model_and_tokenizer(
     model_source: str,
     model_name: str,
     quantization: str = "4bit",
     device_map: str = "auto",
-    torch_dtype: str = "bfloat16",
+    torch_dtype: TorchDtype = "bfloat16",
+    model_max_length: Optional[int] = None,
+    for_training: bool = True,
+    load_format: str = "auto",
+    attn_impl: str = "flash_attention_2",
+    bnb_4bit_quant_type: str = "nf4",
+    bnb_4bit_use_double_quant: bool = True,
+    prefetch_k: int = 1,
 ) -> Tuple["AutoTokenizer", "AutoModelForCausalLM", str]:
     """
     Returns (tokenizer, model, model_path)
+
+    `torch_dtype` (non-quantized path) must be one of bf16/fp16/fp32; bf16 is
+    downgraded to fp16 on GPUs without native support. The dtype actually
+    loaded is available as `model.dtype`.
+
+    `quantization="4bit"` (NF4 + double quant) is the recommended default;
+    "8bit" bitsandbytes inference is usually slower than bf16 for <13B models.
+    `bnb_4bit_quant_type` ("nf4" | "fp4") and `bnb_4bit_use_double_quant`
+    are exposed for A/B comparisons.
+    When `device_map` offloads layers to CPU, the next `prefetch_k` layers
+    (capped by free GPU memory) are copied to the GPU while the current one
+    runs (0 disables).
+
+    The Rust-backed fast tokenizer is preferred; `model_max_length`, when
+    given, caps truncation for batched `tok(..., truncation=True)` calls.
+    Pass `for_training=False` when the model is only used for `generate()`
+    so the KV cache stays enabled. `load_format="prefetch_auto"` reads all
+    local safetensors shards into the page cache concurrently before loading.
+    `attn_impl` falls back to "sdpa" when FlashAttention-2 is unavailable or
+    the model would not load in fp16/bf16.
     """
+    # Checked up front: the quantized path never resolves torch_dtype itself.
+    if torch_dtype not in _DTYPE_NAMES:
+        raise ValueError(f"Unknown torch_dtype: {torch_dtype}")
+
     if model_source == "kaggle":
         try:
             import kagglehub  # installed in Colab first cell
@@ -60,31 +379,57 @@ def load_model_and_tokenizer(
     else:
         raise ValueError(f"Unknown model_source: {model_source}")
 
-    quant_cfg = _maybe_quant_config(quantization)
+    if load_format == "prefetch_auto":
+        _prefetch_shards(model_path)
+    elif load_format != "auto":
+        raise ValueError(f"Unknown load_format: {load_format}")
 
-    tok = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+    if quantization == "8bit":
+        params_b = _estimate_params_b(model_path)
+        if params_b is not None and params_b < 13:
+            print(
+                f"[WARN] 8bit is slower than bf16 for <13B models "
+                f"(~{params_b:.1f}B here); consider quantization: 4bit"
+            )
+
+    quant_cfg = _maybe_quant_config(
+        quantization, bnb_4bit_quant_type, bnb_4bit_use_double_quant
+    )
+    # Non-quantized modules of a 4-bit/8-bit model run in the compute dtype.
+    dtype = _compute_dtype() if quant_cfg is not None else _resolve_dtype(torch_dtype)
+    attn_impl = _resolve_attn_impl(attn_impl, dtype)
+
+    tok = _load_tokenizer(model_path)
+    if model_max_length is not None:
+        tok.model_max_length = model_max_length
 
     if quant_cfg is not None:
         model = AutoModelForCausalLM.from_pretrained(
             model_path,
             device_map=device_map,
             quantization_config=quant_cfg,
+            torch_dtype=dtype,
+            low_cpu_mem_usage=True,
+            use_safetensors=_use_safetensors(model_path),
+            attn_implementation=attn_impl,
         )
     else:
-        try:
-            import torch  # installed in Colab
-
-            dtype = getattr(torch, torch_dtype, None)
-        except Exception:
-            dtype = None  # fallback: let transformers decide
         model = AutoModelForCausalLM.from_pretrained(
             model_path,
             device_map=device_map,
             torch_dtype=dtype,
+            low_cpu_mem_usage=True,
+            use_safetensors=_use_safetensors(model_path),
+            attn_implementation=attn_impl,
         )
 
+    print(f"[i] Model dtype: {getattr(model, 'dtype', 'unknown')}")
+
+    _attach_offload_prefetch(model, prefetch_k)
+
     try:
-        model.config.use_cache = False
+        # KV cache conflicts with gradient checkpointing; keep it for inference.
+        model.config.use_cache = not for_training
     except Exception:
         pass
 
@@ -23,22 +23,86 @@ GOOD_SRC = textwrap.dedent("""
     }
     \"\"\"
 
-    from typing import Iterable, Dict, Any, Tuple
+    from typing import Iterable, Dict, Any, Tuple, List, Optional, Callable, BinaryIO
     from pathlib import Path
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from functools import lru_cache, partial
+    from itertools import islice
     import json
+    import mmap
+    import os
+
+    try:
+        import fastjsonschema
+    except ImportError:
+        # Local/editor-only context; fall back to the (slower) jsonschema package.
+        fastjsonschema = None
+
+    try:
+        import orjson  # SIMD JSON parser
+    except ImportError:
+        orjson = None
 
     REQUIRED_ROLES: Tuple[str, str] = ("user", "assistant")
 
+    # Files up to this size are read in one call and split in memory;
+    # larger ones are streamed line by line.
+    READ_ALL_MAX_BYTES = 256 * 1024 * 1024
+
+    # Lines per task when validating with a process pool
+    CHUNK_LINES = 1024
+    # Below this combined dataset size, process start-up costs more than it saves
+    PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+
+    # Invalid records quoted in the per-file skip summary
+    MAX_WARN_EXAMPLES = 10
+
+    # Fixed padded lengths for `bucket_and_save`; longer records are truncated.
+    DEFAULT_BUCKETS: Tuple[int, ...] = (512, 1024, 2048)
+
+    RecordCheck = Callable[[Dict[str, Any]], Optional[str]]
+    # (line_no, stripped source line or None, error message or None), in file order
+    CheckedLine = Tuple[int, Optional[bytes], Optional[str]]
+
+    _worker_check: Optional[RecordCheck] = None
+
+    def _loads(line: bytes) -> Any:
+        return orjson.loads(line) if orjson is not None else json.loads(line)
+
+    def _mmap_lines(path: Path) -> Iterable[bytes]:
+        # MAP_POPULATE prefaults the whole mapping in one go instead of per-page reads.
+        with path.open("rb") as f:
+            mm = mmap.mmap(
+                f.fileno(), 0, flags=mmap.MAP_PRIVATE | mmap.MAP_POPULATE, prot=mmap.PROT_READ
+            )
+        try:
+            yield from iter(mm.readline, b"")
+        finally:
+            mm.close()
+
+    def _read_lines(path: Path) -> Iterable[bytes]:
+        size = path.stat().st_size
+        if size > READ_ALL_MAX_BYTES:
+            with path.open("rb") as f:
+                yield from f
+            return
+        if size and hasattr(mmap, "MAP_POPULATE"):  # Linux only
+            yield from _mmap_lines(path)
+            return
+        with path.open("rb") as f:
+            data = f.read()
+        yield from data.splitlines()
+
     def _iter_jsonl(path: Path) -> Iterable[Dict[str, Any]]:
-        with path.open("r", encoding="utf-8") as f:
-            for i, line in enumerate(f, 1):
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    yield i, json.loads(line)
-                except json.JSONDecodeError as e:
-                    raise ValueError(f"[{path}] JSON parse error on line {i}: {e}") from e
+        for i, line in enumerate(_read_lines(path), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield i, _loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"[{path}] JSON parse error on line {i}: {e}") from e
 
     def _validate_messages_struct(rec: Dict[str, Any], line_no: int, path: Path) -> None:
         if "messages" not in rec or not isinstance(rec["messages"], list):
@@ -78,6 +142,339 @@ GOOD_SRC = textwrap.dedent("""
             raise ValueError(f"[{p}] contains 0 valid records")
 
         print(f"[OK] {p} validated with {count} records")
+
+    def _compile_schema(schema: Dict[str, Any]) -> RecordCheck:
+        \"\"\"
+        Compiles the schema once; the returned check gives an error message or None.
+
+        fastjsonschema implements drafts 04/06/07 only, so schemas are written (and
+        the jsonschema fallback validates) as draft-07 to keep both backends in step.
+        \"\"\"
+        if fastjsonschema is not None:
+            validate = fastjsonschema.compile(schema)
+
+            def check(rec: Dict[str, Any]) -> Optional[str]:
+                try:
+                    validate(rec)
+                except fastjsonschema.JsonSchemaException as e:
+                    return e.message
+                return None
+
+            return check
+
+        from jsonschema import Draft7Validator
+
+        validator = Draft7Validator(schema)
+
+        def check(rec: Dict[str, Any]) -> Optional[str]:
+            err = next(validator.iter_errors(rec), None)
+            return None if err is None else err.message
+
+        return check
+
+    @lru_cache(maxsize=8)
+    def _get_validator(schema_path: str, mtime: float) -> RecordCheck:
+        # `mtime` is only part of the cache key: editing the schema recompiles it.
+        schema = json.loads(Path(schema_path).read_text(encoding="utf-8"))
+        return _compile_schema(schema)
+
+    def _init_worker(schema_path: str, mtime: float) -> None:
+        # Compiled validators are not picklable; each worker resolves its own.
+        global _worker_check
+        _worker_check = _get_validator(schema_path, mtime)
+
+    def _check_chunk(
+        path: Path, chunk: List[Tuple[int, bytes]], check: Optional[RecordCheck] = None
+    ) -> List[CheckedLine]:
+        check = check or _worker_check
+        out: List[CheckedLine] = []
+        for i, line in chunk:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = _loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"[{path}] JSON parse error on line {i}: {e}") from e
+            err = check(rec)
+            # Valid records keep their source bytes; the parsed dict is not needed again.
+            out.append((i, None, err) if err is not None else (i, line, None))
+        return out
+
+    def _chunked(lines: Iterable[bytes], n: int) -> Iterable[List[Tuple[int, bytes]]]:
+        numbered = enumerate(lines, 1)
+        while True:
+            chunk = list(islice(numbered, n))
+            if not chunk:
+                return
+            yield chunk
+
+    def _map_ordered(
+        pool: ProcessPoolExecutor, fn: Callable, chunks: Iterable[Any], window: int
+    ) -> Iterable[Any]:
+        # Keeps at most `window` tasks in flight so large files are not queued whole.
+        pending: deque = deque()
+        try:
+            for chunk in chunks:
+                pending.append(pool.submit(fn, chunk))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+    def _iter_valid(
+        p: Path,
+        max_n: Optional[int],
+        check: RecordCheck,
+        pool: Optional[ProcessPoolExecutor] = None,
+        stats: Optional[Dict[str, int]] = None,
+    ) -> Iterable[bytes]:
+        # Yields the source line of each valid record. `stats` counts "dropped"
+        # records and flags "truncated" once max_n cut off more lines.
+        stats = stats if stats is not None else {}
+        stats.setdefault("dropped", 0)
+        stats.setdefault("truncated", 0)
+        chunks = _chunked(_read_lines(p), CHUNK_LINES)
+        if pool is None:
+            results = (_check_chunk(p, chunk, check) for chunk in chunks)
+        else:
+            results = _map_ordered(pool, partial(_check_chunk, p), chunks, 2 * (os.cpu_count() or 1))
+
+        n_valid = 0
+        examples: List[str] = []
+        try:
+            for checked in results:
+                for line_no, line, err in checked:
+                    if max_n is not None and n_valid >= max_n:
+                        stats["truncated"] = 1
+                        return
+                    if err is not None:
+                        stats["dropped"] += 1
+                        if len(examples) < MAX_WARN_EXAMPLES:
+                            examples.append(f"line {line_no}: {err}")
+                        continue
+                    yield line
+                    n_valid += 1
+        finally:
+            results.close()
+            if stats["dropped"]:
+                print(
+                    f"[WARN] Skipped {stats['dropped']} invalid records in {p.name}; "
+                    f"first examples: {'; '.join(examples)}"
+                )
+
+    def _copy_prefix(src: Path, f: BinaryIO, n: int) -> None:
+        # Until the first dropped record, the output is exactly the first n records of `src`.
+        lines = (line.strip() for line in _read_lines(src))
+        for line in islice((line for line in lines if line), n):
+            f.write(line + b"\\n")
+
+    def _write_jsonl(
+        path: Path, lines: Iterable[bytes], src: Path, stats: Dict[str, int]
+    ) -> Tuple[int, bool]:
+        \"\"\"
+        Consumes `lines` (from `_iter_valid(src, ..., stats=stats)`) lazily and only
+        writes `path` once a record was dropped or the input truncated. Valid lines
+        are written as read, without re-serializing them.
+
+        Returns (record count, whether `path` was written).
+        \"\"\"
+        count = 0
+        f: Optional[BinaryIO] = None
+        try:
+            for line in lines:
+                if f is None and stats["dropped"]:
+                    f = path.open("wb")
+                    _copy_prefix(src, f, count)
+                if f is not None:
+                    f.write(line + b"\\n")
+                count += 1
+            if f is None and (stats["dropped"] or stats["truncated"]):
+                f = path.open("wb")
+                _copy_prefix(src, f, count)
+        except BaseException:
+            # e.g. a JSON parse error mid-file: don't leave a partial output behind
+            if f is not None:
+                f.close()
+                path.unlink(missing_ok=True)
+            raise
+        if f is None:
+            return count, False
+        f.close()
+        return count, True
+
+    def _validate_file(
+        p: Path, max_n: Optional[int], check: RecordCheck, pool: Optional[ProcessPoolExecutor]
+    ) -> str:
+        out_p = p.with_name(f"{p.stem}.valid.jsonl")
+        stats: Dict[str, int] = {}
+        lines = _iter_valid(p, max_n, check, pool, stats)
+        count, rewritten = _write_jsonl(out_p, lines, p, stats)
+        if count == 0:
+            if rewritten:
+                out_p.unlink()
+            raise ValueError(f"[{p}] contains 0 valid records")
+        if not rewritten:
+            print(f"[OK] {p} already valid ({count} records)")
+            return str(p)
+        print(f"[OK] {p} -> {out_p} ({count} records)")
+        return str(out_p)
+
+    def validate_dataset(
+        train_path: str,
+        eval_path: str,
+        schema_path: str,
+        max_train: Optional[int] = None,
+        max_eval: Optional[int] = None,
+        workers: Optional[int] = None,
+    ) -> Tuple[str, str]:
+        \"\"\"
+        Validates train/eval JSONL against the JSON schema, drops invalid records
+        and applies the optional record limits. Datasets above PARALLEL_MIN_BYTES
+        are validated on `workers` processes (default: all cores); the train and
+        eval files are processed concurrently with one compiled validator.
+
+        Returns the paths of the written `<name>.valid.jsonl` files; an input that
+        is already fully valid (and not truncated) is returned as is.
+        \"\"\"
+        schema_key = (str(Path(schema_path).resolve()), Path(schema_path).stat().st_mtime)
+        check = _get_validator(*schema_key)
+
+        paths = [Path(train_path), Path(eval_path)]
+        for p in paths:
+            if not p.exists():
+                raise FileNotFoundError(f"Dataset file not found: {p}")
+
+        workers = workers or os.cpu_count() or 1
+        pool = None
+        if workers > 1 and sum(p.stat().st_size for p in paths) >= PARALLEL_MIN_BYTES:
+            pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=schema_key)
+            # Fork the workers now, before the per-file threads below exist.
+            pool.submit(int).result()
+
+        try:
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                f_train = ex.submit(_validate_file, paths[0], max_train, check, pool)
+                f_eval = ex.submit(_validate_file, paths[1], max_eval, check, pool)
+                return f_train.result(), f_eval.result()
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    def _format_messages(messages: List[Dict[str, str]]) -> str:
+        # Same prompt layout as `format_example` in the notebook.
+        user = next((m["content"] for m in messages if m["role"] == "user"), "")
+        assistant = next((m["content"] for m in messages if m["role"] == "assistant"), "")
+        return f"<user>\\n{user}\\n</user>\\n<assistant>\\n{assistant}\\n</assistant>"
+
+    def tokenize_and_cache(valid_path: str, tokenizer: Any, out_dir: str, max_len: int = 1024) -> str:
+        \"\"\"
+        Tokenizes a validated JSONL file once and saves it with `save_to_disk`.
+
+        Training can then `datasets.load_from_disk(out_dir)`, which memory-maps the
+        Arrow token arrays instead of re-tokenizing every epoch. Opt-in: the notebook
+        still trains from the raw JSONL (see README). Returns `out_dir`.
+        \"\"\"
+        from datasets import Dataset  # installed in Colab first cell
+
+        ds = Dataset.from_json(valid_path)
+
+        def tokenize_fn(batch: Dict[str, List[Any]]) -> Dict[str, Any]:
+            texts = [_format_messages(msgs) for msgs in batch["messages"]]
+            return tokenizer(texts, truncation=True, max_length=max_len)
+
+        ds = ds.map(
+            tokenize_fn,
+            batched=True,
+            batch_size=1000,
+            # One process per ~1000 records; worker start-up dominates below that.
+            num_proc=max(1, min(os.cpu_count() or 1, len(ds) // 1000)),
+            remove_columns=ds.column_names,
+            load_from_cache_file=True,
+        )
+        ds.save_to_disk(out_dir)
+        print(f"[OK] {valid_path} tokenized -> {out_dir} ({len(ds)} records)")
+        return out_dir
+
+    def bucket_and_save(
+        cache_dir: str,
+        out_dir: str,
+        pad_id: int,
+        buckets: Tuple[int, ...] = DEFAULT_BUCKETS,
+    ) -> Dict[int, int]:
+        \"\"\"
+        Packs a `tokenize_and_cache` output into per-bucket `.npy` arrays:
+        `input_ids_<L>.npy` [N, L], `attention_mask_<L>.npy` [N, L] (uint8) and
+        `length_<L>.npy` [N]. Each record goes to the smallest bucket that fits it.
+
+        Token ids are int16 when every stored id (and `pad_id`) fits, else int32.
+        Opt-in like `tokenize_and_cache` (see README). Returns
+        {bucket length: record count}; read back with `load_bucket`.
+        \"\"\"
+        import numpy as np  # installed in Colab
+        from datasets import load_from_disk
+        from numpy.lib.format import open_memmap
+
+        ds = load_from_disk(cache_dir)
+        buckets = tuple(sorted(buckets))
+
+        lengths = np.empty(len(ds), dtype=np.int32)
+        max_id = pad_id
+        row = 0
+        for batch in ds.iter(batch_size=1000):
+            for ids in batch["input_ids"]:
+                ids = ids[: buckets[-1]]
+                lengths[row] = len(ids)
+                if ids:
+                    max_id = max(max_id, max(ids))
+                row += 1
+        # From the stored ids, not tokenizer.vocab_size, which excludes added tokens.
+        ids_dtype = np.int16 if max_id < 2**15 else np.int32
+        bucket_idx = np.searchsorted(buckets, lengths)  # smallest bucket >= length
+
+        out = Path(out_dir)
+        out.mkdir(parents=True, exist_ok=True)
+        counts: Dict[int, int] = {}
+        ids_mm: Dict[int, Any] = {}
+        mask_mm: Dict[int, Any] = {}
+        for b_i, b in enumerate(buckets):
+            in_bucket = bucket_idx == b_i
+            counts[b] = int(in_bucket.sum())
+            if not counts[b]:
+                continue
+            shape = (counts[b], b)
+            ids_mm[b_i] = open_memmap(out / f"input_ids_{b}.npy", "w+", ids_dtype, shape)
+            ids_mm[b_i][:] = pad_id
+            mask_mm[b_i] = open_memmap(out / f"attention_mask_{b}.npy", "w+", np.uint8, shape)
+            np.save(out / f"length_{b}.npy", lengths[in_bucket])
+
+        cursor = [0] * len(buckets)
+        row = 0
+        for batch in ds.iter(batch_size=1000):
+            for ids in batch["input_ids"]:
+                b_i, n = bucket_idx[row], lengths[row]
+                ids_mm[b_i][cursor[b_i], :n] = ids[:n]
+                mask_mm[b_i][cursor[b_i], :n] = 1
+                cursor[b_i] += 1
+                row += 1
+
+        for mm in (*ids_mm.values(), *mask_mm.values()):
+            mm.flush()
+        print(f"[OK] {cache_dir} bucketed -> {out_dir} {counts}")
+        return counts
+
+    def load_bucket(out_dir: str, bucket: int) -> Dict[str, Any]:
+        \"\"\"Memory-maps the arrays written by `bucket_and_save` for one bucket length.\"\"\"
+        import numpy as np  # installed in Colab
+
+        out = Path(out_dir)
+        return {
+            name: np.load(out / f"{name}_{bucket}.npy", mmap_mode="r")
+            for name in ("input_ids", "attention_mask", "length")
+        }
 """)
 
 # 3) Overwrite the file with the known-good version
@@ -88,10 +485,17 @@ with open(MODULE_PATH, "w", encoding="utf-8") as f:
 spec = importlib.util.spec_from_file_location("prepare_dataset", MODULE_PATH)
 pd_mod = importlib.util.module_from_spec(spec)
 assert spec.loader is not None
+# Register before exec so worker processes can unpickle its functions by name,
+# and so `import prepare_dataset` resolves to the loaded module.
+sys.modules[spec.name] = pd_mod
 spec.loader.exec_module(pd_mod)
 
-# Expose the function in the notebook scope
+# Expose the functions in the notebook scope
 validate_or_raise = pd_mod.validate_or_raise
+validate_dataset = pd_mod.validate_dataset
+tokenize_and_cache = pd_mod.tokenize_and_cache
+bucket_and_save = pd_mod.bucket_and_save
+load_bucket = pd_mod.load_bucket
 
 print("[OK] Loaded prepare_dataset directly from file")
 print(" - has validate_or_raise:", callable(validate_or_raise))